@@ -1,15 +1,24 @@
 import os
 import argparse
 import logging
-import requests
 import asyncio
+import concurrent.futures
+import threading
+import tempfile
 import pytz
 import datetime
-import json
-import jinja2
-import telegram
-import google.oauth2
-import googleapiclient.discovery
+import functools
+import typing
+try:
+    import orjson
+    _loads = orjson.loads
+
+    def _dumps(data) -> str:
+        return orjson.dumps(data).decode()
+except ImportError:
+    import json
+    _loads = json.loads
+    _dumps = json.dumps
 
 
 TIMEZONE = pytz.timezone('Europe/Kyiv')
@@ -17,73 +26,156 @@ DAYS_OFFSET = 1
 PROFILES_SUBDIR = 'profiles'
 STORMGLASS_CACHE_SUBDIR = 'stormglass_cache'
 STORMGLASS_CACHE_FILE = 'stormglass_cache.json'
+STORMGLASS_CACHE_META_FILE = 'stormglass_cache.meta.json'
 STORMGLASS_CREDENTIALS_FILE = 'stormglass_credentials.json'
 GOOGLE_CREDENTIALS_FILE = 'google_credentials.json'
 GOOGLE_SPREADSHEET_FILE = 'google_spreadsheet.json'
 TELEGRAM_CONFIGURATION_FILE = 'telegram_config.json'
 NOTIFICATION_TEMPLATE_FILE = 'notification.j2'
+JINJA_CACHE_SUBDIR = '.jcache'
+STORMGLASS_CACHE_TTL = datetime.timedelta(hours=3)
+STORMGLASS_FORECAST_WINDOW = datetime.timedelta(days=1)
+STORMGLASS_TIMEOUT = (5, 30)
+
+_ENV_CACHE = {}
+_JSON_CACHE = {}
+
+_HTTP = None
+
+
+def _http_session():
+    # Heavy modules are imported where they're needed first, so a run that doesn't touch them doesn't load them
+    global _HTTP
+    if _HTTP is None:
+        import requests
+        import requests.adapters
+        import urllib3.util.retry
+        _HTTP = requests.Session()
+        _HTTP.mount(
+            'https://',
+            requests.adapters.HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=4,
+                max_retries=urllib3.util.retry.Retry(
+                    total=3,
+                    backoff_factor=0.3,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    # Retry-After may be arbitrarily long, the next run will try again instead
+                    respect_retry_after_header=False
+                )
+            )
+        )
+    return _HTTP
+
+
+def _load_json_cached(path: str):
+    # Configuration and credentials files don't change while the process is running
+    if path not in _JSON_CACHE:
+        with open(path, 'rb') as json_file:
+            _JSON_CACHE[path] = _loads(json_file.read())
+    return _JSON_CACHE[path]
+
+
+def _replace_file(path: str, content: bytes) -> None:
+    # The file is replaced atomically through a temporary file of its own, so neither a concurrent reader
+    # nor another process writing the same file ever gets a half-written one
+    temporary_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.tmp', delete=False)
+    try:
+        with temporary_file:
+            temporary_file.write(content)
+        os.replace(temporary_file.name, path)
+    except Exception:
+        os.unlink(temporary_file.name)
+        raise
+
+
+@functools.lru_cache(maxsize=None)
+def _midnight_timestamp(tz: datetime.tzinfo, date: datetime.date) -> int:
+    return int(tz.localize(datetime.datetime.combine(date, datetime.time.min)).timestamp())
+
+
+def _get_day_bounds(tz: datetime.tzinfo, days: int) -> tuple[int, int]:
+    today = datetime.datetime.now(tz).date()
+    today_start = _midnight_timestamp(tz, today)
+    range_start = today_start + 86400 * days
+    range_end = range_start + 86400
+    # A day lasts 86400 seconds unless the clocks are changed, so only then the boundaries are localized one by one
+    # (the offsets are compared at both boundaries, as the requested day may lie before today as well as after it)
+    today_offset = datetime.datetime.fromtimestamp(today_start, tz).utcoffset()
+    if datetime.datetime.fromtimestamp(range_start, tz).utcoffset() != today_offset or \
+            datetime.datetime.fromtimestamp(range_end, tz).utcoffset() != today_offset:
+        range_start = _midnight_timestamp(tz, today + datetime.timedelta(days=days))
+        range_end = _midnight_timestamp(tz, today + datetime.timedelta(days=days + 1))
+    return range_start, range_end
 
 
 class Notifier:
     def __init__(self, configuration_file: str):
-        with open(configuration_file, 'r') as telegram_configuration:
-            self.telegram_configuration = json.load(telegram_configuration)
+        import telegram
+        self.telegram_configuration = _load_json_cached(configuration_file)
         self.telegram_bot = telegram.Bot(self.telegram_configuration['telegram_api_token'])
 
+    async def __aenter__(self):
+        # The bot is initialized once for all the notifications sent within the context
+        await self.telegram_bot.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.telegram_bot.__aexit__(exc_type, exc_value, traceback)
+
     async def notify_people(self, notification_text: str) -> None:
-        async with self.telegram_bot:
-            await self.telegram_bot.send_message(
-                text=notification_text,
-                chat_id=self.telegram_configuration['chat_id']
-            )
+        await self.telegram_bot.send_message(
+            text=notification_text,
+            chat_id=self.telegram_configuration['chat_id']
+        )
 
 
 class Planner:
     def __init__(self, spreadsheet_file: str, credentials_file: str):
-        with open(spreadsheet_file, 'r') as spreadsheet_configuration:
-            spreadsheet_configuration = json.load(spreadsheet_configuration)
+        import google.oauth2.service_account
+        import googleapiclient.discovery
+        spreadsheet_configuration = _load_json_cached(spreadsheet_file)
         credentials = google.oauth2.service_account.Credentials.from_service_account_file(credentials_file)
-        self.spreadsheet_values = googleapiclient\
+        # The header rows (names and Telegram handlers) are fetched along with the shifts in a single request,
+        # if the header range isn't configured, the first two rows of the main range are the header
+        ranges = [spreadsheet_configuration['range']]
+        if 'header_range' in spreadsheet_configuration:
+            ranges.insert(0, spreadsheet_configuration['header_range'])
+        # The discovery document bundled with the client library is used instead of downloading it
+        value_ranges = googleapiclient\
             .discovery\
-            .build('sheets', 'v4', credentials=credentials)\
+            .build('sheets', 'v4', credentials=credentials, cache_discovery=False, static_discovery=True)\
             .spreadsheets()\
             .values()\
-            .get(spreadsheetId=spreadsheet_configuration['spreadsheet_id'], range=spreadsheet_configuration['range'])\
+            .batchGet(
+                spreadsheetId=spreadsheet_configuration['spreadsheet_id'],
+                ranges=ranges,
+                majorDimension='ROWS',
+                # Nothing but the cells' values is needed
+                fields='valueRanges(values)'
+            )\
             .execute()\
-            .get('values', [])
+            .get('valueRanges', [{}])
+        self.spreadsheet_values = value_ranges[-1].get('values', [])
+        self.header_rows = value_ranges[0].get('values', [])[:2]
+        self._names, self._handles = (self.header_rows + [[], []])[:2]
+        # The cache belongs to the instance, so it doesn't outlive the spreadsheet data it's built from
+        self.find_person = functools.lru_cache(maxsize=None)(self._find_person)
 
     def find_shifts(self, tz: datetime.tzinfo, days: int):
-        now = datetime.datetime.now(tz)
-        timestamp_range_start = tz.localize(
-            datetime.datetime.combine(
-                now.date() + datetime.timedelta(days=days),
-                datetime.time.min
-            )
-        ).timestamp()
-        timestamp_range_end = tz.localize(
-            datetime.datetime.combine(
-                now.date() + datetime.timedelta(days=days + 1),
-                datetime.time.min
-            )
-        ).timestamp()
-        tomorrow_shifts = []
-        for row in self.spreadsheet_values:
-            if len(row) > 0:
-                if row[0].isdigit() and timestamp_range_start <= float(row[0]) < timestamp_range_end:
-                    tomorrow_shifts.append(row)
-        return tomorrow_shifts
+        timestamp_range_start, timestamp_range_end = _get_day_bounds(tz=tz, days=days)
+        return [
+            row for row in self.spreadsheet_values
+            if row and row[0].isdecimal() and timestamp_range_start <= int(row[0]) < timestamp_range_end
+        ]
 
     def assign_people(self, shift: list[str]):
-        people = []
-        for i in range(2, len(shift) - 1):
-            if shift[i] == '0':
-                people.append(i)
-        return people
+        return [column for column, mark in enumerate(shift[2:-1], start=2) if mark == '0']
 
-    def find_person(self, column: int):
+    def _find_person(self, column: int):
         return {
-            'name': self.spreadsheet_values[0][column],
-            'telegram_handler': self.spreadsheet_values[1][column]
+            'name': self._names[column],
+            'telegram_handler': self._handles[column]
         }
 
     def form_schedule(self, tz: datetime.tzinfo, days: int):
@@ -103,55 +195,157 @@ class Planner:
 
 
 class Synoptic:
-    def __init__(self, stormglass_credentials_file: str, stormglass_cache_file: str):
-        self.stormglass_data = {}
-        update_cache = True
+    def __init__(
+            self,
+            stormglass_credentials_file: str,
+            stormglass_cache_file: str,
+            stormglass_cache_meta_file: str,
+            forecast_until: int
+    ):
+        self.stormglass_data = None
         current_time = datetime.datetime.now()
-        if os.path.isfile(stormglass_cache_file):
-            modified_time = datetime.datetime.fromtimestamp(os.path.getmtime(stormglass_cache_file))
-            if current_time - modified_time < datetime.timedelta(hours=3):
-                update_cache = False
-        if update_cache:
-            with open(stormglass_credentials_file, 'r') as stormglass_credentials:
-                stormglass_credentials = json.load(stormglass_credentials)
-            weather_response = requests.get(
+        refresh_arguments = (
+            stormglass_credentials_file, stormglass_cache_file, stormglass_cache_meta_file, current_time
+        )
+        cache_age = self._cache_age(stormglass_cache_file, current_time)
+        if cache_age is not None and cache_age >= STORMGLASS_CACHE_TTL:
+            # Serve the stale forecast only if it still reaches the needed horizon,
+            # it will be refreshed in the background for the next run
+            stormglass_data = self._load_cache(stormglass_cache_file)
+            if self._forecast_end(stormglass_data) >= forecast_until:
+                self.stormglass_data = stormglass_data
+                threading.Thread(target=self._refresh, args=refresh_arguments).start()
+        if cache_age is None or (cache_age >= STORMGLASS_CACHE_TTL and self.stormglass_data is None):
+            # Nothing worth serving, so we have to wait for the forecast
+            self.stormglass_data = self._refresh(*refresh_arguments)
+            if self.stormglass_data is None:
+                # The cache is still good only if Stormglass has confirmed it's up to date
+                cache_age = self._cache_age(stormglass_cache_file, current_time)
+                if cache_age is None or cache_age >= STORMGLASS_CACHE_TTL:
+                    raise RuntimeError('the cached forecast is missing or outdated')
+        if self.stormglass_data is None:
+            self.stormglass_data = self._load_cache(stormglass_cache_file)
+
+    @staticmethod
+    def _load_cache(stormglass_cache_file: str) -> dict:
+        with open(stormglass_cache_file, 'rb') as stormglass_cache:
+            return _loads(stormglass_cache.read())
+
+    @staticmethod
+    def _cache_age(stormglass_cache_file: str, current_time: datetime.datetime):
+        if not os.path.isfile(stormglass_cache_file):
+            return None
+        return current_time - datetime.datetime.fromtimestamp(os.path.getmtime(stormglass_cache_file))
+
+    @staticmethod
+    def _forecast_end(stormglass_data: dict) -> int:
+        try:
+            return int(datetime.datetime.fromisoformat(stormglass_data['hours'][-1]['time']).timestamp()) + 3600
+        except (KeyError, IndexError, TypeError, ValueError):
+            return 0
+
+    @staticmethod
+    def _refresh(
+            stormglass_credentials_file: str,
+            stormglass_cache_file: str,
+            stormglass_cache_meta_file: str,
+            current_time: datetime.datetime
+    ) -> typing.Optional[dict]:
+        # Any failure is logged here, as it can happen in a background thread where no one else would notice it
+        try:
+            stormglass_credentials = _load_json_cached(stormglass_credentials_file)
+            request_headers = {
+                'Authorization': stormglass_credentials['stormglass_api_key']
+            }
+            # Revalidate the cached forecast instead of downloading it again if it hasn't been changed
+            stormglass_cache_meta = {}
+            if os.path.isfile(stormglass_cache_file) and os.path.isfile(stormglass_cache_meta_file):
+                with open(stormglass_cache_meta_file, 'rb') as stormglass_cache_meta:
+                    stormglass_cache_meta = _loads(stormglass_cache_meta.read())
+            if stormglass_cache_meta.get('etag'):
+                request_headers['If-None-Match'] = stormglass_cache_meta['etag']
+            if stormglass_cache_meta.get('last_modified'):
+                request_headers['If-Modified-Since'] = stormglass_cache_meta['last_modified']
+            weather_response = _http_session().get(
                 'https://api.stormglass.io/v2/weather/point',
                 params={
                     'lat': '50.435664',
                     'lng': '30.618628',
                     'params': 'airTemperature,pressure,cloudCover,gust,humidity,precipitation,visibility',
                     'start': datetime.datetime.timestamp(current_time),
-                    'end': datetime.datetime.timestamp(current_time + datetime.timedelta(days=1)),
+                    'end': datetime.datetime.timestamp(current_time + STORMGLASS_FORECAST_WINDOW),
                     'source': 'sg'
                 },
-                headers={
-                    'Authorization': stormglass_credentials['stormglass_api_key']
-                }
+                headers=request_headers,
+                timeout=STORMGLASS_TIMEOUT
             )
-            if weather_response.status_code == 200:
-                with open(stormglass_cache_file, 'w') as stormglass_cache:
-                    stormglass_cache.write(weather_response.content.decode('utf-8'))
-        with open(stormglass_cache_file, 'r') as stormglass_cache:
-            self.stormglass_data = json.load(stormglass_cache)
+            if weather_response.status_code == 304:
+                os.utime(stormglass_cache_file, None)
+            elif weather_response.status_code == 200:
+                payload = weather_response.content
+                _replace_file(stormglass_cache_file, payload)
+                _replace_file(stormglass_cache_meta_file, _dumps({
+                    'etag': weather_response.headers.get('ETag'),
+                    'last_modified': weather_response.headers.get('Last-Modified')
+                }).encode())
+                return _loads(payload)
+            else:
+                logging.warning(
+                    f'The weather forecast cache has not been refreshed '
+                    f'(Stormglass has responded with {weather_response.status_code})'
+                )
+        except Exception as e:
+            logging.warning(f'The weather forecast cache has not been refreshed ({e})')
+        return None
 
     def forecast_for_time_range(self, time_start: int, time_end: int):
-        forecast_data = []
-        if 'hours' in self.stormglass_data:
-            for hour_offset, forecast_piece in enumerate(self.stormglass_data['hours']):
-                forecast_piece_time = time_start + hour_offset * 3600
-                if time_start <= forecast_piece_time < time_end:
-                    forecast_piece['time_start'] = forecast_piece_time
-                    forecast_piece['time_end'] = forecast_piece_time + 3600
-                    forecast_data.append(forecast_piece)
-        return forecast_data
+        # The cached forecast pieces are copied, not modified, so they stay intact for another time range
+        hours = self.stormglass_data.get('hours', [])
+        hours_number = max(0, min(len(hours), (time_end - time_start + 3599) // 3600))
+        return [
+            {
+                **hours[hour_offset],
+                'time_start': time_start + hour_offset * 3600,
+                'time_end': time_start + (hour_offset + 1) * 3600
+            }
+            for hour_offset in range(hours_number)
+        ]
+
+
+@functools.lru_cache(maxsize=1024)
+def _format_timestamp(timestamp: int, format_string: str) -> str:
+    return datetime.datetime.fromtimestamp(timestamp, TIMEZONE).strftime(format_string)
 
 
 def timestamp2date(timestamp):
-    return TIMEZONE.localize(datetime.datetime.fromtimestamp(int(timestamp))).strftime("%d.%m.%Y")
+    return _format_timestamp(int(timestamp), "%d.%m.%Y")
 
 
 def timestamp2time(timestamp):
-    return TIMEZONE.localize(datetime.datetime.fromtimestamp(int(timestamp))).strftime("%H:%M")
+    return _format_timestamp(int(timestamp), "%H:%M")
+
+
+def _get_template(profiles_dir: str):
+    import jinja2
+    renderer = _ENV_CACHE.get(profiles_dir)
+    if renderer is None:
+        # The compiled templates are kept on disk, so they aren't parsed again on the next run
+        jinja_cache_dir = os.path.join(profiles_dir, JINJA_CACHE_SUBDIR)
+        os.makedirs(jinja_cache_dir, exist_ok=True)
+        renderer = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(profiles_dir),
+            bytecode_cache=jinja2.FileSystemBytecodeCache(jinja_cache_dir)
+        )
+        renderer.filters['timestamp2date'] = timestamp2date
+        renderer.filters['timestamp2time'] = timestamp2time
+        _ENV_CACHE[profiles_dir] = renderer
+    return renderer.get_template(NOTIFICATION_TEMPLATE_FILE)
+
+
+async def send_notifications(notifier: Notifier, notifications: list[str]) -> None:
+    async with notifier:
+        for notification in notifications:
+            await notifier.notify_people(notification)
 
 
 def main():
@@ -166,35 +360,42 @@ def main():
     stormglass_cache_dir = '/'.join([home_dir, STORMGLASS_CACHE_SUBDIR, ''])
     profiles_dir = '/'.join([home_dir, PROFILES_SUBDIR, arguments.profile, ''])
 
-    # Form the schedule for the tomorrow day
-    planner = Planner(
-        spreadsheet_file=(profiles_dir + GOOGLE_SPREADSHEET_FILE),
-        credentials_file=(profiles_dir + GOOGLE_CREDENTIALS_FILE)
-    )
-    schedule = planner.form_schedule(tz=TIMEZONE, days=DAYS_OFFSET)
-    time_start = min(list(map(lambda shift: shift['time_start'], schedule)))
-    time_end = max(list(map(lambda shift: shift['time_end'], schedule)))
-
-    # Get the weather forecast
-    weather = None
-    try:
-        synoptic = Synoptic(
-            stormglass_credentials_file=(profiles_dir + STORMGLASS_CREDENTIALS_FILE),
-            stormglass_cache_file=(stormglass_cache_dir + STORMGLASS_CACHE_FILE)
+    # Fetch the spreadsheet and the weather forecast simultaneously,
+    # a cached forecast is used only if it reaches the end of the scheduled day, otherwise a fresh one is fetched
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        planner_future = executor.submit(
+            Planner,
+            spreadsheet_file=(profiles_dir + GOOGLE_SPREADSHEET_FILE),
+            credentials_file=(profiles_dir + GOOGLE_CREDENTIALS_FILE)
         )
-        weather = synoptic.forecast_for_time_range(
-            time_start=time_start,
-            time_end=time_end
+        synoptic_future = executor.submit(
+            Synoptic,
+            stormglass_credentials_file=(profiles_dir + STORMGLASS_CREDENTIALS_FILE),
+            stormglass_cache_file=(stormglass_cache_dir + STORMGLASS_CACHE_FILE),
+            stormglass_cache_meta_file=(stormglass_cache_dir + STORMGLASS_CACHE_META_FILE),
+            forecast_until=_get_day_bounds(tz=TIMEZONE, days=DAYS_OFFSET)[1]
         )
-    except Exception as e:
-        logging.warning(f'No weather forecast available ({e}), have to get on without it')
+
+        # Form the schedule for the tomorrow day
+        planner = planner_future.result()
+        schedule = planner.form_schedule(tz=TIMEZONE, days=DAYS_OFFSET)
+        time_start = min(shift['time_start'] for shift in schedule)
+        time_end = max(shift['time_end'] for shift in schedule)
+
+        # Get the weather forecast
+        weather = None
+        try:
+            synoptic = synoptic_future.result()
+            weather = synoptic.forecast_for_time_range(
+                time_start=time_start,
+                time_end=time_end
+            )
+        except Exception as e:
+            logging.warning(f'No weather forecast available ({e}), have to get on without it')
 
     # Form the notification text
     secondary_group = int(time_start / 86400 % 2)
-    renderer = jinja2.Environment(loader=jinja2.FileSystemLoader(profiles_dir))
-    renderer.filters['timestamp2date'] = timestamp2date
-    renderer.filters['timestamp2time'] = timestamp2time
-    renderer = renderer.get_template(NOTIFICATION_TEMPLATE_FILE)
+    renderer = _get_template(profiles_dir)
     notification = renderer.render(
         start_date=time_start,
         schedule=schedule,
@@ -204,7 +405,7 @@ def main():
 
     # Send the notification
     notifier = Notifier(configuration_file=(profiles_dir + TELEGRAM_CONFIGURATION_FILE))
-    asyncio.run(notifier.notify_people(notification))
+    asyncio.run(send_notifications(notifier, [notification]))
 
 
 if __name__ == '__main__':